@@ -1,15 +1,19 @@
 import os
 import random
 import time
+import uuid
 from datetime import datetime
 
 import pollinations
 from PIL import Image
+
+from scheduler_utils import BACKGROUND, INTERACTIVE, NORMAL, scheduler
 """
 This module contains the functions to interact with the Pollinations API.
 The fortune teller class handles the card generation picking a random card from a pool names and adjectives.
 The "golden cards" are also available, these are pre-defined cards with a specific name and adjective.
 It can also generate a text prompt for the user to interpret the card image or to change the card image.
+All the calls to the AI servers are queued in the scheduler (see scheduler_utils.py) with their priority and session.
 """
 
 
@@ -19,12 +23,16 @@ def generate_ai_text(
     system_string : str = "You are a fortune teller reading cards for me",
     ai_model : pollinations.Model = pollinations.Text.openai(),
     img_path : str = "",
-    prev_messages : list = []
+    prev_messages : list = [],
+    model_name : str = "openai",
+    priority : int = INTERACTIVE,
+    session : str = "default"
 ):
     """
     function to generate text from single string prompt.
     default model is openai, but it can be changed to pollinations or other models.
     NB: the image is not used in the prompt, but it can be added to the model to generate a reply.
+    model_name is the name of ai_model for the scheduler rate limits ("openai", "evil"...).
     """
     text_model = pollinations.Text(
         model=ai_model, system=system_string, messages=[], contextual=True
@@ -32,8 +40,11 @@ def generate_ai_text(
     if img_path != "":
         text_model.image(file = img_path)
 
-    response = text_model(
-        prompt=string_prompt, messages = prev_messages, encode=True
+    response = scheduler.run(
+        lambda: text_model(prompt=string_prompt, messages = prev_messages, encode=True),
+        model_name,
+        priority,
+        session
     )
     response_string = str(response.response)
     # format the reply to add \n characters after dots
@@ -44,11 +55,18 @@ def generate_ai_text(
     return replydict
 
 
-def generate_ai_reply(text_model, string_prompt : str = ""):
+def generate_ai_reply(
+        text_model,
+        string_prompt : str = "",
+        model_name : str = "openai",
+        priority : int = NORMAL,
+        session : str = "default"):
     """
     function to interact with multiple prompts, generating a text reply at each step.
     """
-    response = text_model(prompt=string_prompt, encode=True)
+    response = scheduler.run(
+        lambda: text_model(prompt=string_prompt, encode=True), model_name, priority, session
+    )
     response_string = str(response.response)
     # format the reply to add \n characters after dots
     reply = ""
@@ -57,7 +75,12 @@ def generate_ai_reply(text_model, string_prompt : str = ""):
     return reply
 
 
-def generate_ai_image(prompt :str = "", show : bool = False, save_path : str = "generated_images"):
+def generate_ai_image(
+        prompt :str = "",
+        show : bool = False,
+        save_path : str = "generated_images",
+        priority : int = INTERACTIVE,
+        session : str = "default"):
     """
     function to generate images from single string prompt (similar to text generator)
     NB: can be shown only if it is locally saved!
@@ -70,7 +93,7 @@ def generate_ai_image(prompt :str = "", show : bool = False, save_path : str = "
         enhance = True,
         nologo = True,
     )
-    image = image_model(prompt)
+    image = scheduler.run(lambda: image_model(prompt), "flux", priority, session)
     # saving is necessary to access the image
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")  # get time stamp
     image_save_name = f"img_{timestamp}.png"  # name the image and define its path
@@ -92,19 +115,20 @@ def generate_ai_image_reply(
         string_prompt : str = "",
         show = False,
         save_path : str = "generated_images",
-        language : str = "English"):
+        language : str = "English",
+        priority : int = BACKGROUND,
+        session : str = "default"):
     """
     function to interact with multiple prompts (generating a new image starting from the previous at each step)
     """
     image = None
+    image_prompt = ""
     if language == "English":
-        image = img_model(
-            prompt = f"Change the previous image with the following instructions: {string_prompt}. Keep the same fortune teller card format and the same card title, as well as the image style."
-            )
+        image_prompt = f"Change the previous image with the following instructions: {string_prompt}. Keep the same fortune teller card format and the same card title, as well as the image style."
     elif language == "Italiano":
-        image = img_model(
-            prompt = f"Cambia questa immagine con le seguenti istruzioni: {string_prompt}. Mantieni lo stesso formato di carta dei tarocchi e lo stesso titolo della carta, così come lo stile con cui hai generato la prima carta."
-            )
+        image_prompt = f"Cambia questa immagine con le seguenti istruzioni: {string_prompt}. Mantieni lo stesso formato di carta dei tarocchi e lo stesso titolo della carta, così come lo stile con cui hai generato la prima carta."
+    if image_prompt != "":
+        image = scheduler.run(lambda: img_model(prompt = image_prompt), "flux", priority, session)
     # saving is necessary to access the image
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")    # get time stamp
     image_save_name = f"img_{timestamp}.png"    # name the image and define its path
@@ -140,6 +164,8 @@ class Fortune_Teller:
         self.image_model = pollinations.Image()
         self.savepath = savepath
         self.seed = random.randint(0, 1000000)
+        # the session is used by the scheduler to share the AI quota fairly between readings
+        self.session_id = uuid.uuid4().hex
         self.language = os.path.split(datapath)[1]
         if self.language not in self.languages_list:
             print("ERROR - Language not recognized!")
@@ -149,6 +175,9 @@ class Fortune_Teller:
         self.prev_msgs = []
         self.standard_phrases_dict = {}
         self.current_card = ""
+        # keep track of the current image and of the items removed from the pools (needed to checkpoint the session)
+        self.current_image_path = ""
+        self.drawn_items = []
         # we set a default card if somehow a card is not picked before the first profecy
         if self.language == "English":
             self.current_card = "The crazy panda"
@@ -191,18 +220,23 @@ class Fortune_Teller:
         we can either take a whole card name from the "golden cards" pool or randomly mixing the adj/subj pools
         """
         redo = True
+        self.drawn_items = []
+        self.current_image_path = ""
         while redo:
             if random.randint(0, 1) == 0:
                 selected_card = self.cardpool[random.randint(0, len(self.cardpool) - 1)]
                 
                 self.current_card = selected_card
                 self.cardpool.remove(selected_card)
+                self.drawn_items.append(["cardpool", selected_card])
             else:
                 single_subject = self.subjects[random.randint(0, len(self.subjects) - 1)]
                 single_adj = self.adjectives[random.randint(0, len(self.adjectives) - 1)]
 
                 self.subjects.remove(single_subject)
                 self.adjectives.remove(single_adj)
+                self.drawn_items.append(["subjects", single_subject])
+                self.drawn_items.append(["adjectives", single_adj])
 
                 # first we select the proper construction depending on the language
                 if self.language == "English":
@@ -256,7 +290,9 @@ class Fortune_Teller:
 
         # we generate the reply of the fortune teller (so the user can begin reading while waiting the image to be generated)
         # _, profecy = generate_ai_text(text_prompt, self.standard_phrases_dict["system"], card_image_path) # this adds also the image to the prompt (honestly I don't know if it's better or worse)
-        replydict = generate_ai_text(text_prompt, self.standard_phrases_dict["system"])
+        replydict = generate_ai_text(
+            text_prompt, self.standard_phrases_dict["system"], priority = INTERACTIVE, session = self.session_id
+        )
         profecy = replydict["reply"]
 
         self.prev_msgs.append(pollinations.Text.Message( role = self.standard_phrases_dict["referrer"], content = profecy))
@@ -300,7 +336,10 @@ class Fortune_Teller:
             user_prompt,
             self.standard_phrases_dict["system"],
             pollinations.Text.evil(),
-            prev_messages = self.prev_msgs
+            prev_messages = self.prev_msgs,
+            model_name = "evil",
+            priority = NORMAL,
+            session = self.session_id
         )
         self.text_model = replydict["model"]
         evil_reply = replydict["reply"]
@@ -325,7 +364,9 @@ class Fortune_Teller:
                     time.sleep(0.3)
                 return evil_reply
             else:
-                evil_reply = generate_ai_reply(self.text_model, loop_user_reply)
+                evil_reply = generate_ai_reply(
+                    self.text_model, loop_user_reply, "evil", NORMAL, self.session_id
+                )
 
 
     def look_at_the_crystall_ball(self, show_image = False, new_input = "") -> Image:
@@ -348,7 +389,9 @@ class Fortune_Teller:
                 image_prompt,
                 show_image,
                 self.savepath,
-                self.language
+                self.language,
+                BACKGROUND,
+                self.session_id
             )
         else:
             if self.language == "English":
@@ -358,9 +401,12 @@ class Fortune_Teller:
                 card_image_description = f'Carta dei tarocchi che raffigura {self.current_card}. IL testo visibile nella carta è il titolo: "{self.current_card}", in grassetto nel bordo inferiore della carta, in italiano,%20mistico%20divinazione,%20tarocchi,%20cartomante,%202D,%20no prospettiva'
                 image_prompt = f'INPUT = {self.current_card}\n\nOUTPUT = {card_image_description} \n ![IMG](https://image.pollinations.ai/prompt/{card_image_description})'
             # add languages here
-            replydict = generate_ai_image(image_prompt, show_image, self.savepath)
+            # only the first image of the card is interactive, the regenerations can wait
+            priority = INTERACTIVE if self.current_image_path == "" else BACKGROUND
+            replydict = generate_ai_image(image_prompt, show_image, self.savepath, priority, self.session_id)
             self.image_model = replydict["model"]
         
+        self.current_image_path = replydict["path"]
         current_card_image = replydict["reply"]
         return current_card_image
 
@@ -380,7 +426,7 @@ class Fortune_Teller:
         # add languages here 
 
         # we generate the reply of the fortune teller (so the user can begin reading while waiting the image to be generated)
-        replydict = generate_ai_text(text_prompt, self.seed)
+        replydict = generate_ai_text(text_prompt, self.seed, priority = BACKGROUND, session = self.session_id)
         self.text_model = replydict["model"]
         first_summary = replydict["reply"]
 
@@ -400,13 +446,17 @@ class Fortune_Teller:
                 elif self.language == "Italiano": print("\nCartomante: ciao!")
                 return first_summary
             else:
-                summary = generate_ai_reply(self.text_model, loop_user_reply)
+                summary = generate_ai_reply(
+                    self.text_model, loop_user_reply, "openai", NORMAL, self.session_id
+                )
 
 
     def forget_old_profecies(self) -> None:
         self.card_title_history = []
         self.prev_msgs = []
         self.current_card = ""
+        self.current_image_path = ""
+        self.drawn_items = []
 
 
 
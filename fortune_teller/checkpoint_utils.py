@@ -0,0 +1,132 @@
+import json
+import os
+
+import pollinations
+"""
+This module contains the functions to checkpoint a fortune telling session and to resume it later.
+Each session is saved in an append-only json lines file: the first line stores the session info (language, user info, pdf path),
+then a line is appended every time the user accepts a card (card title, profecy, image path and the items removed from the card pools).
+When the session ends a last line is appended, so that only the interrupted sessions can be resumed.
+No AI call is needed to resume a session, the pdf pages are rebuilt from the saved texts and images.
+"""
+
+
+def _append_record(checkpoint_path: str, record: dict) -> None:
+    """
+    Append a single json line to the checkpoint file (flushed to disk, so it survives a crash).
+    If the last line was truncated by a crash, it is closed first so the new record stays readable.
+    """
+    with open(checkpoint_path, "ab") as file:
+        if file.tell() > 0:
+            with open(checkpoint_path, "rb") as old_file:
+                old_file.seek(-1, os.SEEK_END)
+                if old_file.read(1) != b"\n":
+                    file.write(b"\n")
+        file.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _new_checkpoint(
+    checkpoint_dir: str,
+    timestamp: str,
+    language: str,
+    person_dict: dict,
+    pdf_path: str,
+    seed: int
+) -> str:
+    """
+    Create the checkpoint file of a new session and write the session info as first line
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    checkpoint_path = os.path.join(checkpoint_dir, f"{timestamp}session.jsonl")
+    record = {
+        "type": "session",
+        "language": language,
+        "person": person_dict,
+        "pdf_path": pdf_path,
+        "seed": seed,
+    }
+    _append_record(checkpoint_path, record)
+    return checkpoint_path
+
+
+def _append_card_checkpoint(checkpoint_path: str, fortune_teller, profecy: str) -> None:
+    """
+    Append the accepted card to the checkpoint file
+    """
+    record = {
+        "type": "card",
+        "card": fortune_teller.current_card,
+        "profecy": profecy,
+        "image_path": fortune_teller.current_image_path,
+        "drawn": fortune_teller.drawn_items,
+    }
+    _append_record(checkpoint_path, record)
+
+
+def _close_checkpoint(checkpoint_path: str) -> None:
+    """
+    Mark the session as finished, so it will not be resumed
+    """
+    _append_record(checkpoint_path, {"type": "end"})
+
+
+def _load_checkpoint(checkpoint_path: str) -> dict:
+    """
+    Read the checkpoint file and return the session info with the list of accepted cards.
+    Truncated lines (e.g. crash while writing) are ignored, so if the session line is lost
+    the returned dict has no session info ("language", "person"...) and cannot be resumed.
+    """
+    checkpoint = {"cards": [], "finished": False}
+    with open(checkpoint_path, encoding="utf-8", errors="replace") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record["type"] == "session":
+                checkpoint.update(record)
+            elif record["type"] == "card":
+                checkpoint["cards"].append(record)
+            elif record["type"] == "end":
+                checkpoint["finished"] = True
+    return checkpoint
+
+
+def _latest_checkpoint(checkpoint_dir: str) -> str:
+    """
+    Return the path of the most recent unfinished session (empty string if there is none).
+    The checkpoints without session info are skipped.
+    """
+    if not os.path.isdir(checkpoint_dir):
+        return ""
+    for filename in sorted(os.listdir(checkpoint_dir), reverse=True):
+        if filename.endswith("session.jsonl"):
+            checkpoint_path = os.path.join(checkpoint_dir, filename)
+            checkpoint = _load_checkpoint(checkpoint_path)
+            if "language" in checkpoint and not checkpoint["finished"]:
+                return checkpoint_path
+    return ""
+
+
+def _restore_fortune_teller(fortune_teller, checkpoint: dict) -> None:
+    """
+    Rebuild the state of a freshly created Fortune_Teller from the checkpoint:
+    user name, seed, card history, previous messages and remaining card pools
+    """
+    fortune_teller.username = checkpoint["person"]["name"]
+    fortune_teller.seed = checkpoint["seed"]
+    for card in checkpoint["cards"]:
+        for pool_name, item in card["drawn"]:
+            pool = getattr(fortune_teller, pool_name)
+            if item in pool:
+                pool.remove(item)
+        fortune_teller.current_card = card["card"]
+        fortune_teller.current_image_path = card["image_path"]
+        fortune_teller.card_title_history.append(f'"{card["card"]}"')
+        fortune_teller.prev_msgs.append(
+            pollinations.Text.Message(
+                role=fortune_teller.standard_phrases_dict["referrer"], content=card["profecy"]
+            )
+        )
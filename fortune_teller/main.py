@@ -2,9 +2,19 @@ import os
 import sys
 
 from matplotlib.backends.backend_pdf import PdfPages
+from PIL import Image
 
 from ai_utils import *
+from checkpoint_utils import (
+    _append_card_checkpoint,
+    _close_checkpoint,
+    _latest_checkpoint,
+    _load_checkpoint,
+    _new_checkpoint,
+    _restore_fortune_teller,
+)
 from pdf_utils import _image_text_to_pdf, _text_to_pdf
+from scheduler_utils import scheduler
 """
 Enable the test mode to skip the actual fortune telling and just print the picked cards
 TEST_MODE = True
@@ -13,6 +23,128 @@ TEST_MODE = True
 TEST_MODE = False
 
 
+def _read_card(cartomante, person_dict, pdf, checkpoint_path = ""):
+    """
+    Pick a card, tell the profecy and change the card image until the user likes it.
+    The accepted card is saved to the pdf and to the session checkpoint.
+    """
+    name = person_dict['name']
+
+    # first we pick a card
+    cartomante.pick_card()
+
+    # if test mode is enabled we just print the card and skip the rest
+    if TEST_MODE:
+        print(f"{cartomante.current_card}")
+        return
+
+    # we get the profecy related to this card
+    current_profecy = cartomante.hear_the_ancient_voices(person_dict)
+    print(f"\n{cartomante.standard_phrases_dict['referrer']}: {current_profecy}")
+
+    # we change the image until the user is satisfied (i.e. says "yes")
+    right_image = False
+    newcard_prompt = ""
+    while not right_image:
+        image = cartomante.look_at_the_crystall_ball(True, newcard_prompt)
+        print(f"\n{cartomante.standard_phrases_dict['referrer']}: {cartomante.standard_phrases_dict['like_image_string']}")
+        user_reply = input(f'\n{name}: ')
+
+        if user_reply in cartomante.standard_phrases_dict['yes']:
+            right_image = True
+        else:
+            print(f"\n{cartomante.standard_phrases_dict['referrer']}: ok")
+    
+            if user_reply in cartomante.standard_phrases_dict['no']:
+                # if the user doesn't like the image we ask for a new one, keeping the same prompt but with a random seed (so it's always different)
+                newcard_prompt = ""
+            else:
+                # otherwise we give the user reply as prompt for the new image generation
+                newcard_prompt = user_reply
+    
+    # save the current image to pdf and print the text on the side
+    _image_text_to_pdf(image, cartomante.current_card, current_profecy, pdf)
+    if checkpoint_path != "":
+        _append_card_checkpoint(checkpoint_path, cartomante, current_profecy)
+
+
+def _ask_to_continue(cartomante, person_dict, pdf, checkpoint_path = "") -> bool:
+    """
+    Ask the user if wants to continue reading, if not the profecies are summarized and the session is closed
+    """
+    # ask the user if wants to continue reading
+    print(f"\n{cartomante.standard_phrases_dict['referrer']}: {cartomante.standard_phrases_dict['continue_reading_future']}")
+    second_user_reply = input(f'\n{person_dict["name"]}: ')
+
+    # if the user says yes or no it's ok, otherwise it gets angry (if not in test mode)
+    if second_user_reply in cartomante.standard_phrases_dict['yes']:
+        return True
+    elif second_user_reply in cartomante.standard_phrases_dict['no']:
+        if not TEST_MODE:
+            summary_of_profecies = cartomante.summarize_profecies()
+            _text_to_pdf(summary_of_profecies, pdf)
+    elif not TEST_MODE:
+        # now the fortune teller is MAD, the only way to stop is to yell SHUT UP! (zitto in italiano)
+        cartomante.punish_insolence(user_prompt = second_user_reply)
+    else:
+        # in test mode the fortune teller doesn't get angry, the reading just goes on
+        return True
+    if checkpoint_path != "":
+        _close_checkpoint(checkpoint_path)
+    return False
+
+
+def resume(checkpoint_path, save_path):
+    """
+    Resume an interrupted session from its checkpoint file:
+    the state of the fortune teller and the pdf pages of the accepted cards are rebuilt without any AI call
+    """
+    if checkpoint_path == "" or not os.path.isfile(checkpoint_path):
+        print("ERROR - no interrupted session to resume!")
+        return
+    checkpoint = _load_checkpoint(checkpoint_path)
+    if "language" not in checkpoint:
+        print("ERROR - the selected checkpoint has no session info, it cannot be resumed!")
+        return
+    if checkpoint["finished"]:
+        print("ERROR - the selected session is already finished!")
+        return
+
+    language_path = os.path.join(os.path.dirname(__file__), "Languages", checkpoint["language"])
+    cartomante = Fortune_Teller(language_path, save_path)
+    _restore_fortune_teller(cartomante, checkpoint)
+    person_dict = checkpoint["person"]
+
+    with PdfPages(checkpoint["pdf_path"]) as pdf:
+
+        # rebuild the pages of the cards already accepted
+        for card in checkpoint["cards"]:
+            if os.path.isfile(card["image_path"]):
+                _image_text_to_pdf(Image.open(card["image_path"]), card["card"], card["profecy"], pdf)
+            else:
+                print(f"ERROR - missing image of the card {card['card']}, only the profecy is saved")
+                _text_to_pdf(card["profecy"], pdf)
+
+        # then we continue from where we stopped (if no card was accepted yet we start with a new card, as in main)
+        contune_reading = True
+        if checkpoint["cards"]:
+            contune_reading = _ask_to_continue(cartomante, person_dict, pdf, checkpoint_path)
+        while contune_reading:
+            _read_card(cartomante, person_dict, pdf, checkpoint_path)
+            contune_reading = _ask_to_continue(cartomante, person_dict, pdf, checkpoint_path)
+
+
+def print_metrics():
+    """
+    Print the queue depth and the waiting times of the AI calls of all the readings, for each priority class
+    """
+    for priority_name, values in scheduler.metrics().items():
+        print(
+            f"{priority_name}: queue depth {values['queue_depth']}, dispatched {values['dispatched']}, "
+            f"mean wait {values['mean_wait']:.2f} s, max wait {values['max_wait']:.2f} s"
+        )
+
+
 def main():
     # set the base path to the folder where the script is located
     basepath = os.path.split(os.path.dirname(__file__))[0]
@@ -24,6 +156,19 @@ def main():
     pdf_save_path = os.path.join(basepath, "generated_predictions")
     os.makedirs(pdf_save_path, exist_ok=True)
 
+    checkpoint_save_path = os.path.join(basepath, "generated_checkpoints")
+
+    # "resume" restarts the last interrupted session (or the one given as second argument)
+    if len(sys.argv) > 1 and sys.argv[1] == "resume":
+        checkpoint_path = sys.argv[2] if len(sys.argv) > 2 else _latest_checkpoint(checkpoint_save_path)
+        resume(checkpoint_path, save_path)
+        return
+
+    # "metrics" shows the scheduler statistics
+    if len(sys.argv) > 1 and sys.argv[1] == "metrics":
+        print_metrics()
+        return
+
     # select language
     language = ""
     while language == "":
@@ -107,63 +252,20 @@ def main():
             # the loop runs until the user says no (or enters evil mode and says "shut up")
             contune_reading = True
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            pdf_path = os.path.join(pdf_save_path, f'{timestamp}results.pdf')
 
-            with PdfPages(os.path.join(pdf_save_path, f'{timestamp}results.pdf')) as pdf:
-
-                while contune_reading:
-
-                    # first we pick a card
-                    cartomante.pick_card()
-
-                    # if test mode is enabled we just print the card and skip the rest
-                    if TEST_MODE:
-                        print(f"{cartomante.current_card}")
-
-                    else:
+            # the session is checkpointed after each accepted card, so it can be resumed if something goes wrong
+            checkpoint_path = ""
+            if not TEST_MODE:
+                checkpoint_path = _new_checkpoint(
+                    checkpoint_save_path, timestamp, language, person_dict, pdf_path, cartomante.seed
+                )
 
-                        # we get the profecy related to this card
-                        current_profecy = cartomante.hear_the_ancient_voices(person_dict)
-                        print(f"\n{cartomante.standard_phrases_dict['referrer']}: {current_profecy}")
+            with PdfPages(pdf_path) as pdf:
 
-                        # we change the image until the user is satisfied (i.e. says "yes")
-                        right_image = False
-                        newcard_prompt = ""
-                        while not right_image:
-                            image = cartomante.look_at_the_crystall_ball(True, newcard_prompt)
-                            print(f"\n{cartomante.standard_phrases_dict['referrer']}: {cartomante.standard_phrases_dict['like_image_string']}")
-                            user_reply = input(f'\n{name}: ')
-        
-                            if user_reply in cartomante.standard_phrases_dict['yes']:
-                                right_image = True
-                            else:
-                                print(f"\n{cartomante.standard_phrases_dict['referrer']}: ok")
-                        
-                                if user_reply in cartomante.standard_phrases_dict['no']:
-                                    # if the user doesn't like the image we ask for a new one, keeping the same prompt but with a random seed (so it's always different)
-                                    newcard_prompt = ""
-                                else:
-                                    # otherwise we give the user reply as prompt for the new image generation
-                                    newcard_prompt = user_reply
-                        
-                        # save the current image to pdf and print the text on the side
-                        _image_text_to_pdf(image, cartomante.current_card, current_profecy, pdf)
-
-                    # ask the user if wants to continue reading
-                    print(f"\n{cartomante.standard_phrases_dict['referrer']}: {cartomante.standard_phrases_dict['continue_reading_future']}")
-                    second_user_reply = input(f'\n{name}: ')
-
-                    # if the user says yes or no it's ok, otherwise it gets angry (if not in test mode)
-                    if second_user_reply in cartomante.standard_phrases_dict['yes']:
-                        pass
-                    elif second_user_reply in cartomante.standard_phrases_dict['no']:
-                        contune_reading = False
-                        if not TEST_MODE:
-                            summary_of_profecies = cartomante.summarize_profecies()
-                            _text_to_pdf(summary_of_profecies, pdf)
-                    elif not TEST_MODE:
-                        # now the fortune teller is MAD, the only way to stop is to yell SHUT UP! (zitto in italiano)
-                        cartomante.punish_insolence(user_prompt = second_user_reply)
-                        contune_reading = False
+                while contune_reading:
+                    _read_card(cartomante, person_dict, pdf, checkpoint_path)
+                    contune_reading = _ask_to_continue(cartomante, person_dict, pdf, checkpoint_path)
         
         
         # if the user don't want to start the fotune teller says goodbye 
@@ -0,0 +1,296 @@
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+# the state file is locked with the OS file locks (released by the OS also if the process crashes)
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+    fcntl = None
+"""
+This module contains the scheduler used by all the AI calls, so that many readings can share the same Pollinations quota.
+The scheduler state (token buckets, waiting requests, session turns and waiting time statistics) is kept in a json file protected by a lock file,
+so all the fortune_teller-cli processes launched from the same folder draw from the same buckets.
+Each model (openai, evil, flux) has its own token bucket to avoid being throttled by the server.
+The waiting requests are served by priority class (interactive calls first, then conversations, then background work)
+and, inside the same class, the sessions are served in turns so that a single reading cannot take the whole quota.
+The buckets are charged only when more than one session is active: a lone reading is never slowed down.
+The scheduler also keeps track of the queue depth and of the waiting times for each priority class (see fortune_teller-cli metrics).
+"""
+
+# priority classes (lower value = served first)
+INTERACTIVE = 0     # profecies and first card images, the user is waiting for them
+NORMAL = 1          # conversation replies
+BACKGROUND = 2      # summaries, image regenerations, pre-rendering
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal", BACKGROUND: "background"}
+
+# default rate limits per model: (requests per second, burst size)
+# NB: these are not official Pollinations values, just conservative guesses (about one text request every 5 s
+# and one image every 10 s per model), tune them to your Pollinations tier with the FORTUNE_TELLER_RATE_LIMITS
+# environment variable, e.g. FORTUNE_TELLER_RATE_LIMITS="openai=0.5:5,flux=0.2:3" (a rate of 0 disables the limit)
+DEFAULT_RATE_LIMITS = {
+    "openai": (0.2, 3),
+    "evil": (0.2, 3),
+    "flux": (0.1, 2),
+}
+
+# a session is active (i.e. it competes for the quota) if it sent a request in the last seconds
+# (FORTUNE_TELLER_CONTENTION_WINDOW environment variable)
+DEFAULT_CONTENTION_WINDOW = 60.0
+
+DEFAULT_STATE_DIR = os.path.join(os.path.split(os.path.dirname(__file__))[0], "generated_scheduler")
+
+POLL_INTERVAL = 0.1         # seconds between two checks of a waiting request
+STALE_REQUEST = 30.0        # a waiting request not checked for this long belongs to a crashed process
+
+
+def _load_rate_limits() -> dict:
+    """
+    Read the rate limits from the FORTUNE_TELLER_RATE_LIMITS environment variable ("model=rate:burst,...")
+    the models not listed (or with a wrong entry) keep the default limits.
+    The burst must be at least 1 (otherwise the bucket never has a token), a rate of 0 disables the limit.
+    """
+    rate_limits = dict(DEFAULT_RATE_LIMITS)
+    for entry in os.environ.get("FORTUNE_TELLER_RATE_LIMITS", "").split(","):
+        if entry.strip() == "":
+            continue
+        try:
+            model_name, limits = entry.split("=")
+            rate, capacity = limits.split(":")
+            rate, capacity = float(rate), float(capacity)
+            if rate < 0 or (rate > 0 and capacity < 1):
+                raise ValueError
+        except ValueError:
+            print(f"ERROR - rate limit not recognized: {entry}")
+            continue
+        model_name = model_name.strip()
+        if model_name not in DEFAULT_RATE_LIMITS:
+            print(f"WARNING - rate limit for an unknown model: {model_name} (known models: {', '.join(DEFAULT_RATE_LIMITS)})")
+        rate_limits[model_name] = (rate, capacity)
+    return rate_limits
+
+
+def _load_contention_window() -> float:
+    try:
+        return float(os.environ.get("FORTUNE_TELLER_CONTENTION_WINDOW", DEFAULT_CONTENTION_WINDOW))
+    except ValueError:
+        print("ERROR - contention window not recognized, using the default one")
+        return DEFAULT_CONTENTION_WINDOW
+
+
+class Request_Scheduler:
+    """
+    The Request Scheduler decides which AI call can be sent to the server.
+    Every call is queued in the shared state with its model name, priority class and session,
+    and the calling process waits until the call is dispatched (i.e. the model bucket has a token
+    and no call with higher priority, or from a session waiting since longer, is queued for the same model).
+    Any waiting process can dispatch the requests of the others, which collect them at their next check.
+    """
+
+    def __init__(self, state_dir = DEFAULT_STATE_DIR, rate_limits = None, contention_window = None):
+        self.state_dir = state_dir
+        self.state_path = os.path.join(state_dir, "scheduler_state.json")
+        self.lock_path = os.path.join(state_dir, "scheduler_state.lock")
+        self.rate_limits = _load_rate_limits() if rate_limits is None else dict(rate_limits)
+        self.contention_window = _load_contention_window() if contention_window is None else contention_window
+
+
+    @contextmanager
+    def _shared_state(self):
+        """
+        Lock the state file, load it and save it back when the block ends
+        """
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.lock_path, "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                lock_file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            try:
+                state = {"buckets": {}, "queue": [], "sessions": {}, "turns": {}, "stats": {}}
+                if os.path.isfile(self.state_path):
+                    try:
+                        with open(self.state_path, encoding="utf-8") as file:
+                            state.update(json.load(file))
+                    except (json.JSONDecodeError, OSError):
+                        print("ERROR - scheduler state corrupted, starting from an empty one")
+                yield state
+                temp_path = self.state_path + f".{os.getpid()}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as file:
+                    json.dump(state, file)
+                os.replace(temp_path, self.state_path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+    def _get_bucket(self, state, model_name, now) -> dict:
+        """
+        Return the bucket of the model, refilled up to now
+        (unknown models get the same limits of the default text model)
+        """
+        rate, capacity = self.rate_limits.get(model_name, self.rate_limits.get("openai", DEFAULT_RATE_LIMITS["openai"]))
+        bucket = state["buckets"].setdefault(model_name, {"tokens": capacity, "last_refill": now})
+        bucket["tokens"] = min(capacity, bucket["tokens"] + max(now - bucket["last_refill"], 0.0) * rate)
+        bucket["last_refill"] = now
+        return bucket
+
+
+    def _try_consume(self, state, model_name, now) -> bool:
+        rate, _ = self.rate_limits.get(model_name, self.rate_limits.get("openai", DEFAULT_RATE_LIMITS["openai"]))
+        if rate <= 0:
+            return True
+        bucket = self._get_bucket(state, model_name, now)
+        if bucket["tokens"] >= 1:
+            bucket["tokens"] -= 1
+            return True
+        return False
+
+
+    def _time_to_next_token(self, state, model_name, now) -> float:
+        rate, _ = self.rate_limits.get(model_name, self.rate_limits.get("openai", DEFAULT_RATE_LIMITS["openai"]))
+        if rate <= 0:
+            return 0.0
+        bucket = self._get_bucket(state, model_name, now)
+        if bucket["tokens"] >= 1:
+            return 0.0
+        return (1 - bucket["tokens"]) / rate
+
+
+    def _cleanup(self, state, now) -> None:
+        """
+        Remove the requests and the sessions left by crashed or finished processes
+        """
+        state["queue"] = [request for request in state["queue"] if now - request["heartbeat"] < STALE_REQUEST]
+        state["sessions"] = {
+            session: last_seen for session, last_seen in state["sessions"].items()
+            if now - last_seen < self.contention_window
+        }
+        for priority, turns in state["turns"].items():
+            state["turns"][priority] = [session for session in turns if session in state["sessions"]]
+
+
+    def _dispatch(self, state, now) -> None:
+        """
+        Grant as many queued requests as possible, following priority and session turns.
+        A model is blocked for the lower priorities as soon as one of its requests has to wait.
+        If only one session is active the buckets are not charged.
+        """
+        contended = len(state["sessions"]) > 1
+        blocked_models = set()
+        for priority in sorted(PRIORITY_NAMES):
+            turns = state["turns"].setdefault(str(priority), [])
+            for session in list(turns):
+                # the first request of the session whose model is not blocked is served
+                for request in state["queue"]:
+                    if request["granted"] or request["priority"] != priority or request["session"] != session:
+                        continue
+                    if request["model"] in blocked_models:
+                        continue
+                    if contended and not self._try_consume(state, request["model"], now):
+                        blocked_models.add(request["model"])
+                        continue
+                    request["granted"] = True
+                    # the session goes back at the end of the turns
+                    turns.remove(session)
+                    turns.append(session)
+                    break
+
+
+    def _next_refill(self, state, now) -> float:
+        waits = [
+            self._time_to_next_token(state, request["model"], now)
+            for request in state["queue"] if not request["granted"]
+        ]
+        return max(min(waits, default=0.0), 0.01)
+
+
+    def acquire(self, model_name = "openai", priority = NORMAL, session = "default") -> float:
+        """
+        Queue a request and wait until it can be sent, return the waiting time in seconds
+        """
+        enqueued = time.time()
+        request = {
+            "id": uuid.uuid4().hex,
+            "model": model_name,
+            "priority": priority,
+            "session": session,
+            "granted": False,
+            "heartbeat": enqueued,
+        }
+        while True:
+            with self._shared_state() as state:
+                now = time.time()
+                self._cleanup(state, now)
+                own_request = None
+                for queued_request in state["queue"]:
+                    if queued_request["id"] == request["id"]:
+                        own_request = queued_request
+                if own_request is None:
+                    # first check (or the request was dropped while this process was not responding)
+                    own_request = request
+                    state["queue"].append(own_request)
+                own_request["heartbeat"] = now
+                state["sessions"][session] = now
+                turns = state["turns"].setdefault(str(priority), [])
+                if session not in turns:
+                    turns.append(session)
+                self._dispatch(state, now)
+                if own_request["granted"]:
+                    state["queue"].remove(own_request)
+                    wait = now - enqueued
+                    stats = state["stats"].setdefault(
+                        str(priority), {"dispatched": 0, "total_wait": 0.0, "max_wait": 0.0}
+                    )
+                    stats["dispatched"] += 1
+                    stats["total_wait"] += wait
+                    stats["max_wait"] = max(stats["max_wait"], wait)
+                    return wait
+                sleep_time = min(self._next_refill(state, now), POLL_INTERVAL)
+            time.sleep(sleep_time)
+
+
+    def run(self, ai_call, model_name = "openai", priority = NORMAL, session = "default"):
+        """
+        Wait for the scheduler and then execute the AI call, returning its result
+        """
+        self.acquire(model_name, priority, session)
+        return ai_call()
+
+
+    def metrics(self) -> dict:
+        """
+        Return the queue depth and the waiting times (in seconds) of all the readings for each priority class
+        """
+        with self._shared_state() as state:
+            self._cleanup(state, time.time())
+            queued = [request["priority"] for request in state["queue"] if not request["granted"]]
+            all_stats = state["stats"]
+        metrics = {}
+        for priority, name in PRIORITY_NAMES.items():
+            stats = all_stats.get(str(priority), {"dispatched": 0, "total_wait": 0.0, "max_wait": 0.0})
+            dispatched = stats["dispatched"]
+            metrics[name] = {
+                "queue_depth": queued.count(priority),
+                "dispatched": dispatched,
+                "mean_wait": stats["total_wait"] / dispatched if dispatched > 0 else 0.0,
+                "max_wait": stats["max_wait"],
+            }
+        return metrics
+
+
+# all the AI calls of the package go through this scheduler
+scheduler = Request_Scheduler()